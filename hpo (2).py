@@ -8,6 +8,7 @@ import torchvision.transforms as transforms
 from torchvision import datasets, transforms, models
 from collections import OrderedDict
 import argparse
+import copy
 import os
 import logging
 import sys
@@ -15,114 +16,210 @@ from tqdm import tqdm
 from PIL import ImageFile
 
 
+try:
+    from nvidia.dali import fn, types
+    from nvidia.dali.pipeline import pipeline_def
+    from nvidia.dali.plugin.pytorch import DALIClassificationIterator, LastBatchPolicy
+    HAS_DALI = True
+except ImportError:
+    HAS_DALI = False
+
+
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler(sys.stdout))
 
-def test(model, test_loader, criterion, device):
-    model.eval()        
-    running_loss=0      
-    running_corrects=0  
-    
+@torch.inference_mode()
+def test(backbone, head, test_loader, criterion, device):
+    head.eval()
+    total_loss = torch.zeros((), device=device)
+    total_correct = torch.zeros((), device=device, dtype=torch.long)
+    num_samples = 0
+
     for inputs, labels in test_loader:
-        inputs = inputs.to(device)
-        labels = labels.to(device)
-        outputs=model(inputs)
-        loss=criterion(outputs, labels)
-        _, preds = torch.max(outputs, 1)
-        running_loss += loss.item() * inputs.size(0)            # calculate running loss
-        running_corrects += torch.sum(preds == labels.data)     # calculate running corrects
+        inputs = inputs.to(device, non_blocking=True, memory_format=torch.channels_last)
+        labels = labels.to(device, non_blocking=True)
+        if inputs.dtype == torch.uint8:
+            inputs = inputs.float().div_(255.0)
+        with torch.cuda.amp.autocast(dtype=torch.float16, enabled=device.type == 'cuda'):
+            outputs=head(backbone(inputs))
+            loss=criterion(outputs, labels)
+        total_loss += loss.detach() * inputs.size(0)                # accumulate running loss
+        total_correct += (outputs.argmax(dim=1) == labels).sum()    # accumulate running corrects
+        num_samples += inputs.size(0)
 
-    total_loss = running_loss // len(test_loader)       
-    total_acc = running_corrects.double() // len(test_loader)
-    
-    logger.info(f"Testing Loss: {total_loss}")
-    logger.info(f"Testing Accuracy: {total_acc}") # print the loss and accuracy values
+    test_loss = (total_loss / num_samples).item()
+    test_acc = (total_correct.double() / num_samples).item()
+
+    logger.info(f"Testing Loss: {test_loss}")
+    logger.info(f"Testing Accuracy: {test_acc}") # print the loss and accuracy values
     
 
-def train(model, train_loader,loss_criterion, optimizer, device):
-    loss_counter=0
+def extract_features(backbone, loader, device):
+    backbone.eval()
+    feats_list=[]
+    labels_list=[]
+
+    with torch.no_grad():
+        for inputs, labels in loader:
+            inputs = inputs.to(device, non_blocking=True, memory_format=torch.channels_last)
+            if inputs.dtype == torch.uint8:
+                inputs = inputs.float().div_(255.0)
+            with torch.cuda.amp.autocast(dtype=torch.float16, enabled=device.type == 'cuda'):
+                feats = backbone(inputs)
+            feats_list.append(feats.float())
+            labels_list.append(labels.to(device, non_blocking=True))
+
+    return torch.cat(feats_list), torch.cat(labels_list)
+
+
+def train(head, feature_loader, loss_criterion, optimizer, device, accum_steps=1):
     best_loss=1e6
+    best_state=None
     epochs = 50
-    image_dataset={'train':train_loader}
-    
+    patience = 5
+    epochs_since_best = 0
+    scaler = torch.cuda.amp.GradScaler(enabled=device.type == 'cuda')
+    scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, patience=3)
+    head.train()
+
     for epoch in range(epochs):
         logger.info(f"Epoch:{epoch}")
-        for phase in ['train']:
-            if phase == 'train':
-                model.train()
-            else:
-                model.eval()
-            running_loss = 0.0
-            running_corrects = 0
-            
-            for inputs, labels in image_dataset[phase]:
-                inputs = inputs.to(device)
-                labels = labels.to(device)
-                outputs = model(inputs)
+        running_loss = torch.zeros((), device=device)
+        running_corrects = torch.zeros((), device=device, dtype=torch.long)
+        num_samples = 0
+
+        optimizer.zero_grad(set_to_none=True)
+        for step, (feats, labels) in enumerate(feature_loader):
+            with torch.cuda.amp.autocast(dtype=torch.float16, enabled=device.type == 'cuda'):
+                outputs = head(feats)
                 loss = loss_criterion(outputs, labels)
-                
-                if phase == 'train':
-                    optimizer.zero_grad()
-                    loss.backward()
-                    optimizer.step()
-                
-                _, preds = torch.max(outputs, 1)
-                running_loss += loss.item() * inputs.size(0)
-                running_corrects += torch.sum(preds == labels.data)
-                
-            epoch_loss = running_loss // len(image_dataset[phase])
-            epoch_acc = running_corrects // len(image_dataset[phase])
-
-            logger.info('{} loss: {:.4f}, acc: {:.4f}, best loss: {:.4f}'.format(phase,
-                                                                                 epoch_loss,
-                                                                                 epoch_acc,
-                                                                                 best_loss))
-        if loss_counter==1:
-            break
-        if epoch==0:
-            break
-    return model
+
+            scaler.scale(loss / accum_steps).backward()
+            if (step + 1) % accum_steps == 0 or step + 1 == len(feature_loader):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+
+            running_loss += loss.detach() * feats.size(0)
+            running_corrects += (outputs.argmax(dim=1) == labels).sum()
+            num_samples += feats.size(0)
+
+        epoch_loss = (running_loss / num_samples).item()
+        epoch_acc = (running_corrects.double() / num_samples).item()
+
+        logger.info('train loss: {:.4f}, acc: {:.4f}, best loss: {:.4f}'.format(epoch_loss,
+                                                                                epoch_acc,
+                                                                                best_loss))
+        scheduler.step(epoch_loss)
+        if epoch_loss < best_loss:
+            best_loss = epoch_loss
+            best_state = copy.deepcopy(head.state_dict())
+            epochs_since_best = 0
+        else:
+            epochs_since_best += 1
+            if epochs_since_best >= patience:
+                logger.info(f"Early stopping at epoch {epoch}")
+                break
+
+    if best_state is not None:
+        head.load_state_dict(best_state)
+    return head
     
     
 
 def net():
-    model = models.resnet18(pretrained=True)
+    resnet = models.resnet18(pretrained=True)
+
+    for param in resnet.parameters():
+        param.requires_grad = False
+
+    num_features=resnet.fc.in_features
+    backbone = nn.Sequential(*list(resnet.children())[:-1], nn.Flatten())
+    backbone.eval()     # frozen, so keep BN running stats fixed too
+    head = nn.Linear(num_features, 8)
+    return backbone, head
+
+
+
+if HAS_DALI:
+    @pipeline_def
+    def _dali_pipeline(data_path, train):
+        jpegs, labels = fn.readers.file(file_root=data_path, random_shuffle=train, name='Reader')
+        images = fn.decoders.image(jpegs, device='mixed')
+        if train:
+            images = fn.random_resized_crop(images, device='gpu', size=224)
+            images = fn.flip(images, device='gpu', horizontal=fn.random.coin_flip())
+        else:
+            images = fn.resize(images, device='gpu', size=(224, 224))
+        # match ToTensor(): float output scaled to [0, 1]
+        images = fn.crop_mirror_normalize(images, device='gpu', dtype=types.FLOAT,
+                                          output_layout='CHW',
+                                          mean=[0.0, 0.0, 0.0], std=[255.0, 255.0, 255.0])
+        return images, labels
 
-    for param in model.parameters():
-        param.requires_grad = False   
 
-    num_features=model.fc.in_features
-    model.fc = nn.Sequential(
-                   nn.Linear(num_features, 8))
-    return model
+class DALILoader:
+    """Wraps a DALIClassificationIterator so it yields (inputs, labels) like a DataLoader."""
 
+    def __init__(self, pipeline):
+        self.dali_iter = DALIClassificationIterator(pipeline, reader_name='Reader',
+                                                    auto_reset=True,
+                                                    last_batch_policy=LastBatchPolicy.PARTIAL)
+
+    def __iter__(self):
+        for batch in self.dali_iter:
+            yield batch[0]['data'], batch[0]['label'].squeeze(-1).long()
+
+    def __len__(self):
+        return len(self.dali_iter)
+
+
+def create_dali_loaders(data, batch_size):
+    num_threads = min(8, os.cpu_count())
+    train_pipe = _dali_pipeline(os.path.join(data, 'train'), train=True,
+                                batch_size=batch_size, num_threads=num_threads,
+                                device_id=0, prefetch_queue_depth=2)
+    test_pipe = _dali_pipeline(os.path.join(data, 'test'), train=False,
+                               batch_size=batch_size, num_threads=num_threads,
+                               device_id=0, prefetch_queue_depth=2)
+    return DALILoader(train_pipe), DALILoader(test_pipe)
 
 
 def create_data_loaders(data, batch_size):
-    
-    train_data_path = os.path.join(data, 'train') 
+
+    if HAS_DALI and torch.cuda.is_available():
+        return create_dali_loaders(data, batch_size)
+
+    train_data_path = os.path.join(data, 'train')
     test_data_path = os.path.join(data, 'test')
     
     
+    # keep batches uint8 on the CPU side; the GPU does the float cast + /255
     train_transform = transforms.Compose([
         transforms.RandomResizedCrop((224, 224)),
         transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
+        transforms.PILToTensor(),
         ])
-                                                            
+
     test_transform = transforms.Compose([
         transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        ]) 
+        transforms.PILToTensor(),
+        ])
 
     
     train_data = torchvision.datasets.ImageFolder(root=train_data_path, transform=train_transform)
-    train_data_loader = torch.utils.data.DataLoader(train_data, batch_size=batch_size, shuffle=True)
+    num_workers = min(8, os.cpu_count())
+
+    train_data_loader = torch.utils.data.DataLoader(train_data, batch_size=batch_size, shuffle=True,
+                                                    num_workers=num_workers, persistent_workers=True,
+                                                    prefetch_factor=4, pin_memory=True)
 
     test_data = torchvision.datasets.ImageFolder(root=test_data_path, transform=test_transform)
-    test_data_loader  = torch.utils.data.DataLoader(test_data, batch_size=batch_size)
+    test_data_loader  = torch.utils.data.DataLoader(test_data, batch_size=batch_size,
+                                                    num_workers=num_workers, persistent_workers=True,
+                                                    prefetch_factor=4, pin_memory=True)
 
 
     
@@ -132,26 +229,35 @@ def create_data_loaders(data, batch_size):
 def main(args): 
     
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision('high')
     print(f"Running on Device {device}")
     logger.info(f'Hyperparameters are LR: {args.lr}, Batch Size: {args.batch_size}')
     logger.info(f'Data Paths: {args.data}')
-    train_loader=create_data_loaders(args.data, args.batch_size)
-    test_loader=create_data_loaders(args.data, args.batch_size)
-   
-    model=net() 
-    model=model.to(device)
+    train_loader, test_loader = create_data_loaders(args.data, args.batch_size)
+
+    backbone, head = net()
+    backbone=backbone.to(device, memory_format=torch.channels_last)
+    if hasattr(torch, 'compile'):
+        backbone = torch.compile(backbone, mode='max-autotune', dynamic=False)
+    head=head.to(device)
     loss_criterion = nn.CrossEntropyLoss(ignore_index=133)
-    optimizer = optim.Adam(model.fc.parameters(), lr=args.lr) 
-    
+    optimizer = optim.Adam(head.parameters(), lr=args.lr)
+
+    logger.info("Caching Backbone Features")
+    train_feats, train_labels = extract_features(backbone, train_loader, device)
+    feature_data = torch.utils.data.TensorDataset(train_feats, train_labels)
+    feature_loader = torch.utils.data.DataLoader(feature_data, batch_size=4096, shuffle=True)
+
     logger.info("Start Model Training")
-    model=train(model, train_loader, loss_criterion, optimizer, device) 
-    
+    head=train(head, feature_loader, loss_criterion, optimizer, device, args.accum_steps)
+
     logger.info("Testing Model")
-    test(model, test_loader, loss_criterion, device) 
-    
+    test(backbone, head, test_loader, loss_criterion, device)
+
 
     logger.info("Saving Model")
-    torch.save(model.state_dict(), os.path.join(args.model_dir, "model.pth")) 
+    torch.save(head.state_dict(), os.path.join(args.model_dir, "model.pth"))
 
 if __name__ == '__main__':
     
@@ -169,6 +275,14 @@ if __name__ == '__main__':
     parser.add_argument(
         "--lr", type = float, default = 0.1, metavar = "LR", help = "learning rate (default: 1.0)"
     )
+
+    parser.add_argument(
+        "--accum_steps",
+        type = int,
+        default = 1,
+        metavar = "K",
+        help = "number of batches to accumulate gradients over before an optimizer step (default: 1)",
+    )
     
     parser.add_argument('--data', type=str, default=os.environ['SM_CHANNEL_TRAIN'])
     parser.add_argument('--model_dir', type=str, default=os.environ['SM_MODEL_DIR'])